@@ -133,6 +133,61 @@ class SequentialLoader:
     def __iter__(self):
         yield from chain(*self.dataloaders)
 
+class DataPrefetcher:
+    """
+    Class to stream batches from a DataLoader already moved to a given device. On CUDA, the copy of the next batch
+    is issued on a side stream so it overlaps with compute on the current one.
+
+    :param loader: DataLoader to prefetch batches from, ideally with pin_memory=True
+    :type loader: DataLoader
+    :param device: Device to move each batch to
+    :type device: Union[str, torch.device]
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield _batch_to_device(batch, self.device)
+            return
+
+        loader = iter(self.loader)
+        batch = self._preload(loader)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the batch was allocated on the side stream, so tell the allocator it's used on this one too
+            for tensor in batch if isinstance(batch, (tuple, list)) else (batch,):
+                tensor.record_stream(current_stream)
+
+            next_batch = self._preload(loader)
+            yield batch
+            batch = next_batch
+
+    def _preload(self, loader):
+        try:
+            batch = next(loader)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return _batch_to_device(batch, self.device, non_blocking=True)
+
+
+def _batch_to_device(batch, device, non_blocking=False):
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(x.to(device, non_blocking=non_blocking) for x in batch)
+
+    return batch.to(device, non_blocking=non_blocking)
+
+
 def _standard_collate(
     sample: List[tuple],
     normalize: bool,
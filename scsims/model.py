@@ -2,6 +2,7 @@ from functools import partial
 from typing import Any, Callable, Dict, Union
 
 import os
+import warnings
 import anndata as an
 import numpy as np
 import pandas as pd
@@ -10,19 +11,16 @@ import torch
 import torch.nn.functional as F
 from pytorch_tabnet.tab_network import TabNet
 from pytorch_tabnet.utils import create_explain_matrix
-from scipy.sparse import csc_matrix
 from torchmetrics.functional.classification.stat_scores import _stat_scores_update
 from tqdm import tqdm
 import torch.utils.data
 from scipy.sparse import csr_matrix
-from scsims.data import CollateLoader
+from scsims.data import CollateLoader, DataPrefetcher
 from scsims.inference import DatasetForInference
 from scsims.temperature_scaling import _ECELoss
-from torchmetrics import Accuracy, F1Score, Precision, Recall, Specificity
+from torchmetrics import Accuracy, F1Score, MetricCollection, Precision, Recall, Specificity
 from sklearn.preprocessing import LabelEncoder
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
 class SIMSClassifier(pl.LightningModule):
     def __init__(
         self,
@@ -46,7 +44,7 @@ class SIMSClassifier(pl.LightningModule):
         scheduler_params: Dict[str, float] = None,
         weights: torch.Tensor = None,
         loss: Callable = None,  # will default to cross_entropy
-        pretrained: bool = None,
+        pretrained: torch.nn.Module = None,
         no_explain: bool = False,
         genes: list[str] = None,
         cells: list[str] = None,
@@ -55,7 +53,8 @@ class SIMSClassifier(pl.LightningModule):
         **kwargs,
     ) -> None:
         super().__init__()
-        self.save_hyperparameters()
+        # modules and callables don't belong in the checkpoint hparams, they're only needed to build the model
+        self.save_hyperparameters(ignore=["pretrained", "loss", "optim_params", "scheduler_params"])
         self.genes = genes
         self.label_encoder = label_encoder
 
@@ -64,19 +63,13 @@ class SIMSClassifier(pl.LightningModule):
         self.output_dim = output_dim
         self.lambda_sparse = lambda_sparse
         self.optim_params = optim_params
-        self.weights = weights
-        self.loss = loss
-
-        if self.loss is None:
-            self.loss = F.cross_entropy
-
-        if pretrained is not None:
-            self._from_pretrained(**pretrained.get_params())
-
-        self.metrics = {
-            "train": {x: y.to(device) for x, y in aggregate_metrics(num_classes=self.output_dim).items()},
-            "val": {x: y.to(device) for x, y in aggregate_metrics(num_classes=self.output_dim).items()},
-        }
+        # a buffer so the class weights follow the module to its device
+        self.register_buffer(
+            "class_weights",
+            weights.float().contiguous() if weights is not None else None,
+            persistent=False,
+        )
+        self.loss = loss if loss is not None else F.cross_entropy
 
         self.optim_params = (
             optim_params
@@ -97,6 +90,11 @@ class SIMSClassifier(pl.LightningModule):
             }
         )
 
+        # running per-class tp/fp/tn/fn for each stage, kept on device so each step
+        # only does an in-place add and the host transfer happens once per epoch
+        self.register_buffer("_train_stat_scores", torch.zeros(4, output_dim, dtype=torch.long), persistent=False)
+        self.register_buffer("_val_stat_scores", torch.zeros(4, output_dim, dtype=torch.long), persistent=False)
+
         print(f"Initializing network")
         self.network = TabNet(
             input_dim=input_dim,
@@ -116,6 +114,9 @@ class SIMSClassifier(pl.LightningModule):
             mask_type=mask_type,
         )
 
+        if pretrained is not None:
+            self.load_weights_from_unsupervised(pretrained)
+
         print(f"Initializing explain matrix")
         if not no_explain:
             self.reducing_matrix = create_explain_matrix(
@@ -125,9 +126,55 @@ class SIMSClassifier(pl.LightningModule):
                 self.network.post_embed_dim,
             )
 
+            # transposed float32 csr copy with int32 indices, so the reduction runs on the network's device.
+            # a plain attribute since ddp can't broadcast sparse buffers, moved to other devices on first use
+            reducing_matrix_t = self.reducing_matrix.T.tocsr()
+            reducing_matrix_t = torch.sparse_csr_tensor(
+                torch.from_numpy(reducing_matrix_t.indptr.astype(np.int32)),
+                torch.from_numpy(reducing_matrix_t.indices.astype(np.int32)),
+                torch.from_numpy(reducing_matrix_t.data.astype(np.float32)),
+                size=reducing_matrix_t.shape,
+            )
+            self._reducing_matrix_t = {reducing_matrix_t.device: reducing_matrix_t}
+
         self._inference_device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.temperature = torch.nn.Parameter(torch.ones(1) * 1.5)
 
+    def load_weights_from_unsupervised(self, unsupervised_model):
+        """
+        Initialize the network from the embedder and encoder of a pretrained TabNetPretraining model.
+        Raises if none of them fit the network and warns about any that don't match in shape
+        """
+        network_state = self.network.state_dict()
+        # TabNetPretraining is the network itself, but also accept wrappers that hold it as .network
+        pretrained_state = getattr(unsupervised_model, "network", unsupervised_model).state_dict()
+
+        # the pretraining encoder lives under tabnet.encoder in the classifier
+        pretrained_state = {
+            (f"tabnet.{k}" if k.startswith("encoder") else k): v for k, v in pretrained_state.items()
+        }
+        # the decoder has no counterpart in the classifier, so only the embedder and encoder are expected to load
+        pretrained_state = {
+            k: v for k, v in pretrained_state.items() if k.startswith(("embedder", "tabnet.encoder"))
+        }
+        matching = {
+            k: v for k, v in pretrained_state.items() if k in network_state and network_state[k].shape == v.shape
+        }
+        skipped = sorted(set(pretrained_state) - set(matching))
+
+        if not matching:
+            raise ValueError(
+                "None of the pretrained encoder weights match the network, check that input_dim, n_d, n_a and n_steps "
+                "are the same as in the pretrained model"
+            )
+        if skipped:
+            warnings.warn(
+                f"{len(skipped)} of {len(pretrained_state)} pretrained encoder weights don't match the network and were "
+                f"skipped, e.g. {skipped[:3]}. Check that n_d, n_a and n_steps are the same as in the pretrained model"
+            )
+
+        self.network.load_state_dict(matching, strict=False)
+
     def forward(self, x):
         logits, M_loss = self.network(x)
         # temp scaling will be 1 so logits wont change until model is calibrated
@@ -137,78 +184,74 @@ class SIMSClassifier(pl.LightningModule):
         x, y = batch
         logits, M_loss = self.network(x)
 
-        loss = self.loss(logits, y, weight=self.weights)
+        loss = self.loss(logits, y, weight=self.class_weights)
         loss = loss - self.lambda_sparse * M_loss
 
-        # take softmax for metrics
-        probs = logits.softmax(dim=-1)
-
-        # if binary, probs will be (batch, 2), so take second column
-        if probs.shape[-1] == 2:
-            probs = probs[:, 1]
-
-        tp, fp, _, fn = _stat_scores_update(
+        # all the metrics are derived from these, so they are only computed once per batch
+        tp, fp, tn, fn = _stat_scores_update(
             preds=logits,
             target=y,
             num_classes=self.output_dim,
             reduce="macro",
         )
 
+        getattr(self, f"_{tag}_stat_scores").add_(torch.stack([tp, fp, tn, fn]).detach())
+
         return {
             "loss": loss,
-            "tp": tp,
-            "fp": fp,
-            "fn": fn,
-            "probs": probs,
         }
 
+    def _epoch_end(self, tag):
+        # each process only saw its own shard, so sum the counts over all of them first.
+        # reduce works in place under ddp, so hand it a copy rather than the running buffer
+        stat_scores = self.trainer.strategy.reduce(getattr(self, f"_{tag}_stat_scores").clone(), reduce_op="sum")
+        for name, value in derive_metrics(*stat_scores).items():
+            self.log(f"{tag}_{name}", value=value, on_epoch=True, on_step=False)
+
+        # single device -> host transfer for the whole epoch
+        tp, fp, _, fn = stat_scores.cpu().numpy()
+        self.log(f"{tag}_median_f1", median_f1(tp, fp, fn), on_epoch=True, on_step=False)
+
     # Calculations on step
     def training_step(self, batch, batch_idx):
         results = self._step(batch, "train")
         self.log(f"train_loss", results["loss"], on_epoch=True, on_step=True)
-        for name, metric in self.metrics["train"].items():
-            value = metric(results["probs"], batch[1])
-            self.log(f"train_{name}", value=value)
 
         return results["loss"]
 
+    def on_train_epoch_start(self) -> None:
+        self._train_stat_scores.zero_()
+
     def on_train_epoch_end(self) -> None:
-        for name, metric in self.metrics["train"].items():
-            value = metric.compute()
-            self.log(f"train_{name}", value=value)
-            metric.reset() # inplace
+        self._epoch_end("train")
 
     def validation_step(self, batch, batch_idx):
         results = self._step(batch, "val")
-        self.log(f"val_loss", results["loss"], on_epoch=True, on_step=True)
-        for name, metric in self.metrics["val"].items():
-            value = metric(results["probs"], batch[1])
-            self.log(f"val_{name}", value=value)
+        self.log(f"val_loss", results["loss"], on_epoch=True, on_step=False)
 
         return results["loss"]
 
+    def on_validation_epoch_start(self) -> None:
+        self._val_stat_scores.zero_()
+
     def on_validation_epoch_end(self) -> None:
-        for name, metric in self.metrics["val"].items():
-            value = metric.compute()
-            self.log(f"val_{name}", value=value)
-            metric.reset()
+        self._epoch_end("val")
 
     def configure_optimizers(self):
-        if "optimizer" in self.optim_params:
-            optimizer = self.optim_params.pop("optimizer")
-            optimizer = optimizer(self.parameters(), **self.optim_params)
-        else:
-            optimizer = torch.optim.Adam(self.parameters(), **self.optim_params)
+        # read the classes without popping them, so this can be called more than once (e.g. lr finder, resuming)
+        optimizer_cls = self.optim_params.get("optimizer", torch.optim.Adam)
+        optimizer_kwargs = {k: v for k, v in self.optim_params.items() if k != "optimizer"}
+        optimizer = optimizer_cls(self.parameters(), **optimizer_kwargs)
         print(f"Initializing with {optimizer = }")
 
-        if self.scheduler_params is not None:
-            scheduler = self.scheduler_params.pop("scheduler")
-            scheduler = scheduler(optimizer, **self.scheduler_params)
-            print(f"Initializating with {scheduler = }")
-
         if self.scheduler_params is None:
             return optimizer
 
+        scheduler_cls = self.scheduler_params.get("scheduler", torch.optim.lr_scheduler.ReduceLROnPlateau)
+        scheduler_kwargs = {k: v for k, v in self.scheduler_params.items() if k != "scheduler"}
+        scheduler = scheduler_cls(optimizer, **scheduler_kwargs)
+        print(f"Initializating with {scheduler = }")
+
         return {
             "optimizer": optimizer,
             "lr_scheduler": scheduler,
@@ -256,6 +299,8 @@ class SIMSClassifier(pl.LightningModule):
             inference_data = DatasetForInference(inference_data.X[rows, :] if rows is not None else inference_data.X)
 
         if not isinstance(inference_data, torch.utils.data.DataLoader):
+            # pinned batches let DataPrefetcher copy them to the gpu asynchronously
+            kwargs.setdefault("pin_memory", self.device.type == "cuda")
             inference_data = CollateLoader(
                 dataset=inference_data,
                 batch_size=batch_size,
@@ -278,43 +323,62 @@ class SIMSClassifier(pl.LightningModule):
     ) -> tuple[np.ndarray, np.ndarray]:
         loader = self._parse_data(anndata, batch_size=batch_size, num_workers=num_workers, rows=rows, currgenes=currgenes, refgenes=refgenes, **kwargs)
 
+        prev_network_state = self.network.training
         self.network.eval()
-        res_explain = []
 
-        all_labels = np.empty(len(loader.dataset))
+        # outputs are preallocated and filled batch by batch
+        num_samples = len(loader.dataset)
+        num_features = self.reducing_matrix.shape[1]
+        res_explain = np.empty((num_samples, num_features), dtype=np.float32)
+        res_masks = {}
+
+        all_labels = np.empty(num_samples)
         all_labels[:] = np.nan
 
-        for batch_nb, data in enumerate(tqdm(loader)):
-            # if we are running this on already labeled pairs and not just for inference
-            if isinstance(data, tuple):
-                X, label = data
-                all_labels[batch_nb * batch_size : (batch_nb + 1) * batch_size] = label
-            else:
-                X = data.float()
-
-            M_explain, masks = self.network.forward_masks(X)
-            for key, value in masks.items():
-                masks[key] = csc_matrix.dot(
-                    value.cpu().detach().numpy(), self.reducing_matrix
-                )
-
-            original_feat_explain = csc_matrix.dot(M_explain.cpu().detach().numpy(),
-                                                   self.reducing_matrix)
-            res_explain.append(original_feat_explain)
-
-            if batch_nb == 0:
-                res_masks = masks
-            else:
+        with torch.inference_mode():
+            start = 0
+            for data in tqdm(DataPrefetcher(loader, self.device)):
+                # if we are running this on already labeled pairs and not just for inference
+                if isinstance(data, (tuple, list)):
+                    X, label = data
+                else:
+                    X, label = data, None
+                X = X.float()
+                end = start + X.shape[0]
+
+                if label is not None:
+                    all_labels[start:end] = label.cpu().numpy()
+
+                M_explain, masks = self.network.forward_masks(X)
+                res_explain[start:end] = self._reduce_explain(M_explain)
+
                 for key, value in masks.items():
-                    res_masks[key] = np.vstack([res_masks[key], value])
+                    if key not in res_masks:
+                        res_masks[key] = np.empty((num_samples, num_features), dtype=np.float32)
+                    res_masks[key][start:end] = self._reduce_explain(value)
 
-        res_explain = np.vstack(res_explain)
+                start = end
+
+        # if network was in training mode before explaining, set it back to that
+        if prev_network_state:
+            self.network.train()
 
         if normalize:
             res_explain /= np.sum(res_explain, axis=1)[:, None]
 
         return res_explain, all_labels
 
+    def _reduce_explain(self, M: torch.Tensor) -> np.ndarray:
+        """
+        Map an explain matrix over the embedded features back onto the original features
+        """
+        if M.device not in self._reducing_matrix_t:
+            reducing_matrix_t = next(iter(self._reducing_matrix_t.values()))
+            self._reducing_matrix_t[M.device] = reducing_matrix_t.to(M.device)
+
+        # torch only multiplies sparse @ dense, so compute (R^T M^T)^T == M R
+        return torch.mm(self._reducing_matrix_t[M.device], M.detach().T.contiguous()).T.cpu().numpy()
+
     def _compute_feature_importances(self, dataloader):
         M_explain, _ = self.explain(dataloader, normalize=False)
         sum_explain = M_explain.sum(axis=0)
@@ -343,40 +407,40 @@ class SIMSClassifier(pl.LightningModule):
             **kwargs
         )
 
-        # initialize arrays in memory and fill with nans to start
-        # this makes it easier to see bugs/wrong predictions than filling zeros
+        # filled with -1/nans on the model's device so rows that never get written are easy to spot
+        num_samples = len(loader.dataset)
         num_cls_to_save = min(3, len(self.label_encoder.classes_))
-        preds = np.empty((len(loader.dataset), num_cls_to_save))
-        preds[:] = np.nan
-
-        all_labels = np.empty(len(loader.dataset))
-        all_labels[:] = np.nan
-
-        # save probs 
-        probs = np.empty((len(loader.dataset), num_cls_to_save))
-        probs[:] = np.nan
+        preds = torch.full((num_samples, num_cls_to_save), -1, dtype=torch.int32, device=self.device)
+        probs = torch.full((num_samples, num_cls_to_save), np.nan, dtype=torch.float64, device=self.device)
+        all_labels = torch.full((num_samples,), np.nan, dtype=torch.float64, device=self.device)
 
         prev_network_state = self.network.training
         self.network.eval()
 
-        # batch size might differ if user passes in a dataloader
-        batch_size = loader.batch_size
-        for idx, X in enumerate(tqdm(loader)):
-            # Some dataloaders will have all_labels, handle this case
-            top_probs, top_preds, label = self.predict_step(batch=X, batch_idx=idx)
-            all_labels[idx * batch_size : (idx + 1) * batch_size] = label
-            preds[idx * batch_size : (idx + 1) * batch_size] = top_preds
-            probs[idx * batch_size : (idx + 1) * batch_size] = top_probs
-
-        preds = pd.DataFrame(preds).astype(int)
-
-        preds = preds.rename(columns={i: f"pred_{i}" for i in range(preds.shape[1])})
-        preds = preds.apply(lambda x: self.label_encoder.inverse_transform(x))
-
-        probs = pd.DataFrame(probs)
-        probs = probs.rename(columns={i: f"prob_{i}" for i in range(probs.shape[1])})
-
-        final = pd.concat([preds, probs], axis=1)
+        # batch size might differ if user passes in a dataloader, so track the offset directly
+        with torch.inference_mode():
+            start = 0
+            for idx, X in enumerate(tqdm(DataPrefetcher(loader, self.device))):
+                # Some dataloaders will have all_labels, handle this case
+                top_probs, top_preds, label = self.predict_step(batch=X, batch_idx=idx)
+                end = start + top_preds.shape[0]
+                if label is not None:
+                    all_labels[start:end] = label
+                preds[start:end] = top_preds
+                probs[start:end] = top_probs
+                start = end
+
+        preds = preds.cpu().numpy()
+        probs = probs.cpu().numpy()
+        all_labels = all_labels.cpu().numpy()
+
+        # decode flattened and reshape back to (samples, top k)
+        decoded = self.label_encoder.inverse_transform(preds.ravel()).reshape(preds.shape)
+
+        final = pd.DataFrame({
+            **{f"pred_{i}": decoded[:, i] for i in range(num_cls_to_save)},
+            **{f"prob_{i}": probs[:, i] for i in range(num_cls_to_save)},
+        })
 
         if not np.all(np.isnan(all_labels)):
             final["label"] = all_labels
@@ -395,10 +459,11 @@ class SIMSClassifier(pl.LightningModule):
         data = data.float()
         res = self(data)[0]
         num_sample = min(len(self.label_encoder.classes_), 3)
-        probs, top_preds = res.topk(num_sample, axis=1)  # to get indices
+        # sorted, since the columns are ordered by probability. int32 is plenty for class indices
+        probs, top_preds = res.topk(num_sample, dim=1, sorted=True)
         probs = probs.softmax(dim=-1)
 
-        return probs.detach().cpu().numpy(), top_preds.detach().cpu().numpy(), label
+        return probs.detach(), top_preds.detach().to(torch.int32), label
  
     def temperature_scale(self, logits):
         """
@@ -453,32 +518,75 @@ class SIMSClassifier(pl.LightningModule):
         return self
 
 def confusion_matrix(model, dataloader, num_classes):
-    confusion_matrix = torch.zeros(num_classes, num_classes)
-    with torch.no_grad():
+    # counts are accumulated flattened on the model's device, row-major over (true, predicted)
+    device = next(model.parameters()).device
+    confusion_matrix = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+    with torch.inference_mode():
         for i, (inputs, classes) in enumerate(tqdm(dataloader)):
-            outputs, _ = model(inputs)
+            outputs, _ = model(inputs.to(device))
 
             _, preds = torch.max(outputs, 1)
-            for t, p in zip(classes.view(-1), preds.view(-1)):
-                confusion_matrix[t.long(), p.long()] += 1
+            idx = classes.to(device).view(-1).long() * num_classes + preds.view(-1).long()
+            confusion_matrix += torch.bincount(idx, minlength=num_classes * num_classes)
 
-    return confusion_matrix
+    return confusion_matrix.view(num_classes, num_classes).float().cpu()
 
 
 def median_f1(tps, fps, fns):
-    precisions = tps / (tps + fps)
-    recalls = tps / (tps + fns)
-
-    f1s = 2 * (np.dot(precisions, recalls)) / (precisions + recalls)
-
-    return np.nanmedian(f1s)
+    tps = np.asarray(tps, dtype=np.float64)
+    # per-class f1 = 2pr / (p + r) = 2tp / (2tp + fp + fn), in a single pass
+    denom = 2 * tps + fps + fns
+    present = denom > 0
+    f1s = np.divide(2 * tps, denom, out=np.zeros_like(denom), where=present)
+
+    # classes that never appear in the targets or predictions don't count
+    if not present.any():
+        return 0.0
+
+    return np.median(f1s[present])
+
+
+def derive_metrics(tp, fp, tn, fn) -> Dict[str, torch.Tensor]:
+    """
+    Compute the classification metrics from per-class stat scores. Macro averages only count the classes
+    that show up in either the targets or the predictions, like torchmetrics does. With two classes the
+    metrics are scored on the positive class, matching torchmetrics' binary task.
+    """
+    tp, fp, tn, fn = tp.float(), fp.float(), tn.float(), fn.float()
+    accuracy = tp.sum() / (tp + fn).sum()
+
+    binary = tp.shape[-1] == 2
+    if binary:
+        tp, fp, tn, fn = tp[1:], fp[1:], tn[1:], fn[1:]
+        present = torch.ones_like(tp)
+    else:
+        present = (tp + fp + fn > 0).float()
+
+    def macro(scores):
+        return (scores.nan_to_num_() * present).sum() / present.sum()
+
+    recall = macro(tp / (tp + fn))
+
+    return {
+        "micro_accuracy": accuracy,
+        # per-class accuracy is per-class recall, binary accuracy has no averaging
+        "macro_accuracy": accuracy if binary else recall,
+        # and weighting it by support gives back the micro accuracy
+        "weighted_accuracy": accuracy,
+        "precision": macro(tp / (tp + fp)),
+        "recall": recall,
+        "f1": macro(2 * tp / (2 * tp + fp + fn)),
+        "specificity": macro(tn / (tn + fp)),
+    }
 
 
-def aggregate_metrics(num_classes) -> Dict[str, Callable]:
+def aggregate_metrics(num_classes) -> MetricCollection:
     task = "binary" if num_classes == 2 else "multiclass"
     num_classes = None if num_classes == 2 else num_classes
 
-    metrics = {
+    # a collection shares the stat-score state between metrics of the same kind, so one update feeds them all.
+    # metrics are stateful, so a fresh collection is built per call instead of caching one
+    metrics = MetricCollection({
         "micro_accuracy": Accuracy(task=task, num_classes=num_classes, average="micro"),
         "macro_accuracy": Accuracy(task=task, num_classes=num_classes, average="macro"),
         "weighted_accuracy": Accuracy(task=task, num_classes=num_classes, average="weighted"),
@@ -486,7 +594,7 @@ def aggregate_metrics(num_classes) -> Dict[str, Callable]:
         "recall": Recall(task=task, num_classes=num_classes, average="macro"),
         "f1": F1Score(task=task, num_classes=num_classes, average="macro"),
         "specificity": Specificity(task=task, num_classes=num_classes, average="macro"),
-    }
+    })
 
     return metrics
 
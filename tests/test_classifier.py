@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+import pytorch_lightning as pl
+import torch
+
+from scsims.model import SIMSClassifier
+from scsims.pretraining import TabNetPretraining
+
+
+class TestClassifier(unittest.TestCase):
+    def test_class_weights_survive_checkpoint(self):
+        weights = torch.tensor([0.5, 1.0, 2.0])
+        model = SIMSClassifier(input_dim=10, output_dim=3, weights=weights, no_explain=True)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "model.ckpt")
+            torch.save(
+                {
+                    "state_dict": model.state_dict(),
+                    "hyper_parameters": dict(model.hparams),
+                    "pytorch-lightning_version": pl.__version__,
+                },
+                path,
+            )
+            reloaded = SIMSClassifier.load_from_checkpoint(path)
+
+        self.assertTrue(torch.equal(reloaded.class_weights, weights))
+
+    def test_load_weights_from_unsupervised(self):
+        pretrained = TabNetPretraining(input_dim=10, n_d=8, n_a=8, n_steps=3)
+        model = SIMSClassifier(input_dim=10, output_dim=3, n_d=8, n_a=8, n_steps=3, pretrained=pretrained, no_explain=True)
+
+        encoder_state = model.network.tabnet.encoder.state_dict()
+        for name, value in pretrained.encoder.state_dict().items():
+            with self.subTest(parameter=name):
+                self.assertTrue(torch.equal(encoder_state[name], value))
+
+    def test_load_weights_from_unsupervised_mismatch_warns(self):
+        pretrained = TabNetPretraining(input_dim=10, n_d=16, n_a=16, n_steps=3)
+
+        with self.assertWarns(UserWarning):
+            SIMSClassifier(input_dim=10, output_dim=3, n_d=8, n_a=8, n_steps=3, pretrained=pretrained, no_explain=True)
+
+    def test_configure_optimizers_is_reentrant(self):
+        optim_params = {"optimizer": torch.optim.SGD, "lr": 0.1}
+        scheduler_params = {"scheduler": torch.optim.lr_scheduler.ReduceLROnPlateau, "factor": 0.5}
+        model = SIMSClassifier(
+            input_dim=10,
+            output_dim=3,
+            optim_params=dict(optim_params),
+            scheduler_params=dict(scheduler_params),
+            no_explain=True,
+        )
+
+        for _ in range(2):
+            config = model.configure_optimizers()
+            self.assertIsInstance(config["optimizer"], torch.optim.SGD)
+            self.assertIsInstance(config["lr_scheduler"], torch.optim.lr_scheduler.ReduceLROnPlateau)
+
+        self.assertEqual(model.optim_params, optim_params)
+        self.assertEqual(model.scheduler_params, scheduler_params)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+import torch
+from torchmetrics.functional.classification.stat_scores import _stat_scores_update
+
+from scsims.model import aggregate_metrics, confusion_matrix, derive_metrics, median_f1
+
+
+class _LogitsModel(torch.nn.Module):
+    """Returns its inputs as the logits, like a network returning (logits, M_loss)"""
+
+    def __init__(self):
+        super().__init__()
+        self.dummy = torch.nn.Parameter(torch.zeros(1))
+
+    def forward(self, x):
+        return x, None
+
+
+class TestMetrics(unittest.TestCase):
+    def test_median_f1(self):
+        tps = np.array([2, 0, 3, 0])
+        fps = np.array([2, 1, 0, 0])
+        fns = np.array([0, 1, 1, 0])
+
+        # per-class f1 is 2/3, 0, 6/7 and the last class is absent
+        self.assertAlmostEqual(median_f1(tps, fps, fns), 2 / 3)
+
+    def test_median_f1_no_classes_present(self):
+        zeros = np.zeros(3, dtype=int)
+
+        self.assertEqual(median_f1(zeros, zeros, zeros), 0.0)
+
+    def _assert_matches_torchmetrics(self, logits, target):
+        num_classes = logits.shape[1]
+        tp, fp, tn, fn = _stat_scores_update(preds=logits, target=target, num_classes=num_classes, reduce="macro")
+        derived = derive_metrics(tp, fp, tn, fn)
+
+        # torchmetrics' binary metrics take the positive class probability
+        probs = logits.softmax(dim=-1)
+        if num_classes == 2:
+            probs = probs[:, 1]
+
+        for name, metric in aggregate_metrics(num_classes).items():
+            with self.subTest(metric=name):
+                self.assertAlmostEqual(derived[name].item(), metric(probs, target).item(), places=5)
+
+    def test_derive_metrics_multiclass(self):
+        torch.manual_seed(0)
+        self._assert_matches_torchmetrics(torch.randn(200, 5), torch.randint(5, (200,)))
+
+    def test_derive_metrics_multiclass_absent_class(self):
+        torch.manual_seed(0)
+        logits = torch.randn(200, 6)
+        # the last class is never predicted or a target, so it shouldn't count towards the macro averages
+        logits[:, 5] = -1e4
+        self._assert_matches_torchmetrics(logits, torch.randint(5, (200,)))
+
+    def test_derive_metrics_binary(self):
+        torch.manual_seed(0)
+        self._assert_matches_torchmetrics(torch.randn(200, 2), torch.randint(2, (200,)))
+
+    def test_confusion_matrix_matches_loop(self):
+        torch.manual_seed(0)
+        num_classes = 5
+        batches = []
+        for _ in range(4):
+            logits = torch.randn(16, num_classes)
+            # the last class is never predicted or a target
+            logits[:, -1] = -1e4
+            batches.append((logits, torch.randint(num_classes - 1, (16,))))
+
+        expected = torch.zeros(num_classes, num_classes)
+        for logits, classes in batches:
+            for t, p in zip(classes.view(-1), logits.argmax(dim=1).view(-1)):
+                expected[t.long(), p.long()] += 1
+
+        result = confusion_matrix(_LogitsModel(), batches, num_classes)
+
+        self.assertTrue(torch.equal(result, expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
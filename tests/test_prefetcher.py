@@ -0,0 +1,37 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from scsims.data import DataPrefetcher
+
+
+class TestDataPrefetcher(unittest.TestCase):
+    def test_labeled_batches(self):
+        data, labels = torch.randn(10, 3), torch.arange(10)
+        loader = DataLoader(TensorDataset(data, labels), batch_size=4)
+
+        batches = list(DataPrefetcher(loader, "cpu"))
+
+        self.assertEqual(len(batches), len(loader))
+        for (X, y), (expected_X, expected_y) in zip(batches, loader):
+            self.assertEqual(X.device, torch.device("cpu"))
+            self.assertEqual(y.device, torch.device("cpu"))
+            self.assertTrue(torch.equal(X, expected_X))
+            self.assertTrue(torch.equal(y, expected_y))
+
+    def test_unlabeled_batches(self):
+        data = torch.randn(10, 3)
+        loader = DataLoader(data, batch_size=4)
+
+        batches = list(DataPrefetcher(loader, torch.device("cpu")))
+
+        self.assertEqual(len(batches), len(loader))
+        for X, expected in zip(batches, loader):
+            self.assertIsInstance(X, torch.Tensor)
+            self.assertEqual(X.device, torch.device("cpu"))
+            self.assertTrue(torch.equal(X, expected))
+
+
+if __name__ == "__main__":
+    unittest.main()